@@ -2,93 +2,571 @@
 
 import os
 import fnmatch
-import pyperclip
+import functools
 import argparse
+import hashlib
+import json
+import mmap
+import queue
 import re
-import yaml
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+# .promptify/ holds saved profiles and the scan cache, never project files
+default_excludes = [
+    "*.pyc",
+    "*egg-info*",
+    "*tmp*",
+    ".DS_Store",
+    ".env*",
+    ".promptify/*",
+]
+default_max_file_bytes = 2 * 1024 * 1024
+default_cache_path = ".promptify/scan.cache"
+
+# Files with these extensions are wrapped in a code block in the output
+_CODE_EXTENSIONS = (
+    ".py",
+    ".json",
+    ".js",
+    ".html",
+    ".css",
+    ".java",
+    ".cpp",
+    ".c",
+    ".h",
+    ".yaml",
+    ".yml",
+)
+
+# Reads are I/O bound and release the GIL, so use more threads than cores
+_READ_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# Maximum number of file reads in flight (bounds memory on large repos)
+_READ_AHEAD = 64
+# os.path.normcase only changes paths on Windows; elsewhere skip the call
+_NORMCASE_NEEDED = os.path.normcase("A/") != "A/"
+# Threads and buffered results for --parallel-walk
+_WALK_WORKERS = 8
+_WALK_HIGH_WATER = 64
+# Common API key patterns, combined so a single scan finds any of them
+_API_KEY_RE = re.compile(
+    r"[a-zA-Z0-9]{32}"  # 32 alphanumeric characters
+    r"|sk_[a-zA-Z0-9]{64}"  # Stripe secret key pattern
+    r"|pk_[a-zA-Z0-9]{64}"  # Stripe public key pattern
+    # Add more patterns as needed
+)
+# How far around an "API_KEY" marker to look for the key itself
+_API_KEY_WINDOW_BEFORE = 256
+_API_KEY_WINDOW_AFTER = 512
+# Rough characters-per-token ratio used to estimate --max-tokens usage
+_CHARS_PER_TOKEN = 3.5
+# Fraction of --max-tokens after which files are counted exactly
+_EXACT_COUNT_THRESHOLD = 0.95
+# How far over --max-tokens the final output may be before it's truncated
+_TRUNCATE_TOLERANCE = 1.05
+# Approximate size of the pieces handed to the tokenizer in one batch
+_TOKENIZER_CHUNK_SIZE = 64 * 1024
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_patterns(patterns):
+    """Compile a tuple of glob patterns into a single regex."""
+    if not patterns:
+        return re.compile(r"(?!)")  # Matches nothing, like any() over []
+
+    return re.compile(
+        "|".join(
+            f"(?:{fnmatch.translate(os.path.normcase(pattern))})"
+            for pattern in patterns
+        )
+    )
+
+
+def _scan_dir(dir_path, prefix):
+    """List one directory as (subdirs, files) for the walkers.
+
+    subdirs holds (dir_path, relative_prefix) pairs to descend into, and files
+    holds (relative_path, file_path, stat_result) triples. A directory that
+    can't be read, or that contains a pyvenv.cfg (a virtual environment),
+    yields nothing at all.
+    """
+    try:
+        with os.scandir(dir_path) as it:
+            entries = list(it)
+    except OSError:
+        return [], []
+
+    if any(entry.name == "pyvenv.cfg" for entry in entries):
+        return [], []
+
+    subdirs = []
+    files = []
+    for entry in entries:
+        if entry.is_dir():
+            # Like os.walk, don't descend into symlinked directories
+            if not entry.is_symlink():
+                subdirs.append((entry.path, prefix + entry.name + os.sep))
+            continue
+
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        files.append((prefix + entry.name, entry.path, stat))
+
+    return subdirs, files
+
+
+def _scandir_files(root):
+    """Yield (relative_path, file_path, stat_result) for every file below root.
+
+    Directories containing a pyvenv.cfg (virtual environments) are skipped
+    entirely, along with everything beneath them.
+    """
+    stack = deque([(root, "")])
+
+    while stack:
+        subdirs, files = _scan_dir(*stack.pop())
+        yield from files
+
+        # Push in reverse so directories are visited in scandir order
+        stack.extend(reversed(subdirs))
+
+
+def _parallel_walk(root, max_workers=_WALK_WORKERS, high_water=_WALK_HIGH_WATER):
+    """Like _scandir_files, but scans directories on a pool of threads.
+
+    Files are yielded in no particular order. Each directory's files are
+    passed back as one list, and at most high_water of those lists are
+    buffered, so the walkers block when the consumer falls behind.
+    """
+    work_q = queue.Queue()
+    result_q = queue.Queue(maxsize=high_water)
+    done = object()
+    stop = threading.Event()
+    lock = threading.Lock()
+    pending = 1  # Directories queued but not scanned yet
+
+    def worker():
+        nonlocal pending
+        while True:
+            item = work_q.get()
+            if item is None:
+                return
+
+            try:
+                if not stop.is_set():
+                    subdirs, files = _scan_dir(*item)
+                    with lock:
+                        pending += len(subdirs)
+                    for subdir in subdirs:
+                        work_q.put(subdir)
+                    if files:
+                        result_q.put(files)
+            finally:
+                with lock:
+                    pending -= 1
+                    finished = pending == 0
+                if finished:
+                    for _ in range(max_workers):
+                        work_q.put(None)
+                    result_q.put(done)
+
+    work_q.put((root, ""))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(worker) for _ in range(max_workers)]
+        try:
+            while True:
+                files = result_q.get()
+                if files is done:
+                    break
+                yield from files
+        finally:
+            # If the consumer stopped early, unblock the workers so they exit
+            stop.set()
+            while not all(future.done() for future in futures):
+                try:
+                    result_q.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+
+        for future in futures:
+            future.result()
+
+
+def _iter_files(root, parallel=False):
+    if parallel:
+        return _parallel_walk(root)
+    return _scandir_files(root)
+
+
+def _read_file_utf8(file_path):
+    """Return the file's text, or None if it isn't valid UTF-8."""
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return f.read()
+    except UnicodeDecodeError:
+        return None
+
+
+def _read_files(file_paths):
+    """Read files concurrently, yielding their contents in input order."""
+    with ThreadPoolExecutor(max_workers=_READ_WORKERS) as executor:
+        pending = deque()
+        for file_path in file_paths:
+            if len(pending) >= _READ_AHEAD:
+                yield pending.popleft().result()
+            pending.append(executor.submit(_read_file_utf8, file_path))
+
+        while pending:
+            yield pending.popleft().result()
+
+
+class _Cache:
+    """Token counts of each file's output block from previous runs, in SQLite."""
+
+    def __init__(self, path=default_cache_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Autocommit, so lookups don't hold a lock; new rows are written in
+        # one short transaction by close(), so a second run in the same
+        # directory isn't blocked for long and there's no fsync per file
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._updates = []
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS blocks ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, "
+            "token_count INTEGER, sha1 BLOB)"
+        )
+
+    def token_count(self, file_path, stat, relative_path, content):
+        """Return the token count of the file's block, tokenizing on a miss."""
+        if self._conn is None:
+            return _count_tokens(_file_block(relative_path, content))
+
+        try:
+            return self._lookup_or_store(file_path, stat, relative_path, content)
+        except sqlite3.Error as e:
+            print(f"Cache error, continuing without it: {str(e)}")
+            self._updates = []
+            self.close()
+            return _count_tokens(_file_block(relative_path, content))
+
+    def _lookup_or_store(self, file_path, stat, relative_path, content):
+        row = self._conn.execute(
+            "SELECT mtime_ns, size, token_count, sha1 FROM blocks WHERE path = ?",
+            (file_path,),
+        ).fetchone()
+        if row and row[:2] == (stat.st_mtime_ns, stat.st_size):
+            return row[2]
+
+        sha1 = hashlib.sha1(content.encode("utf-8")).digest()
+        if row and row[3] == sha1:
+            # Touched but unchanged (e.g. after a checkout)
+            token_count = row[2]
+        else:
+            token_count = _count_tokens(_file_block(relative_path, content))
 
-from tabulate import tabulate
-from token_count import TokenCount
-from collections import defaultdict
+        self._updates.append(
+            (file_path, stat.st_mtime_ns, stat.st_size, token_count, sha1)
+        )
+        return token_count
+
+    def close(self):
+        """Write the new and changed rows, then close the database."""
+        if self._conn is None:
+            return
+
+        try:
+            if self._updates:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?)",
+                    self._updates,
+                )
+                self._conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            print(f"Failed to update cache: {str(e)}")
+        finally:
+            self._updates = []
+            self._conn.close()
+            self._conn = None
+
+
+def _is_same_file(a, b):
+    try:
+        return os.path.samefile(a, b)
+    except OSError:
+        return False
+
+
+def _file_block(relative_path, content):
+    """Return a file's block of the output, as if another file followed it.
 
-default_excludes = ["*.pyc", "*egg-info*", "*tmp*", ".DS_Store", ".env*"]
+    The output splits into these blocks right before each "---" header, which
+    is a token boundary, so their token counts add up to the output's.
+    """
+    if relative_path.endswith(_CODE_EXTENSIONS):
+        content = f"```\n{content}\n```"
+    return f"---\nFile: `{relative_path}`\n\n{content}\n\n"
+
+
+def _written_text(buf, out):
+    """Return the output written so far, from buf or by reading back out."""
+    if out is None:
+        return str(buf, "utf-8")
+
+    out.flush()
+    out.seek(0)
+    data = out.read()
+    out.seek(0, os.SEEK_END)
+    return str(data, "utf-8")
 
 
 def aggregate_file_contents(
-    include_files, exclude_files, ignore_empty_files=False, no_skip=False
+    include_files,
+    exclude_files,
+    ignore_empty_files=False,
+    no_skip=False,
+    max_file_bytes=default_max_file_bytes,
+    cache=None,
+    parallel_walk=False,
+    out=None,
+    max_tokens=None,
 ):
-    result = []
+    """Aggregate the matching files' contents as UTF-8 bytes.
+
+    If out (a binary file object) is given the output is streamed to it as it
+    is produced and None is returned in place of the bytes. With max_tokens,
+    no more files are added once the (estimated) token count reaches it.
+    """
+    buf = bytearray()
+    write = buf.extend if out is None else out.write
     current_dir = os.getcwd()
 
     files_included = []
     files_skipped = []
 
-    for root, dirs, files in os.walk(current_dir):
-        if "pyvenv.cfg" in files:
-            dirs[:] = []
+    # With a cache, tokens are counted per file block and summed.
+    # last_block is (relative_path, content, cached count) of the latest file
+    token_count = 0
+    last_block = None
+    # Running token usage for max_tokens: estimated from the character count
+    # until close to the budget, then counted exactly (cached counts always
+    # are exact)
+    used_tokens = 0
+    exact_budget = cache is not None
+
+    include_re = _compile_patterns(tuple(include_files))
+    exclude_re = _compile_patterns(tuple(exclude_files + default_excludes))
+
+    # Don't pick up the output file itself if it's inside the tree. Only
+    # files with the same name are stat'ed: on Windows the walk's stat
+    # results have no inode numbers to compare
+    if out is not None:
+        out_path = os.path.abspath(out.name)
+        out_name = os.path.normcase(os.path.basename(out_path))
+
+    candidates = []
+    for relative_path, file_path, stat in _iter_files(current_dir, parallel_walk):
+        normalized_path = (
+            os.path.normcase(relative_path) if _NORMCASE_NEEDED else relative_path
+        )
+        if not include_re.match(normalized_path) or exclude_re.match(normalized_path):
+            continue
+
+        if (
+            out is not None
+            and os.path.normcase(relative_path.rpartition(os.sep)[2]) == out_name
+            and _is_same_file(file_path, out_path)
+        ):
             continue
 
-        for file in files:
-            file_path = os.path.join(root, file)
-            relative_path = os.path.relpath(file_path, current_dir)
+        # Use the file size to rule files out before paying for open + read
+        if ignore_empty_files and stat.st_size == 0:
+            continue
+
+        if max_file_bytes and stat.st_size > max_file_bytes:
+            files_skipped.append(
+                relative_path
+                + f" (Larger than {max_file_bytes} bytes. Run with --max-file-bytes 0 to include)"
+            )
+            continue
 
-            if any(
-                fnmatch.fnmatch(relative_path, pattern) for pattern in include_files
-            ) and not any(
-                fnmatch.fnmatch(relative_path, pattern)
-                for pattern in exclude_files + default_excludes
-            ):
+        candidates.append((relative_path, file_path, stat))
 
-                try:
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        content = f.read()
-                except UnicodeDecodeError:
-                    # print(f"Warning: Unable to read {relative_path} as UTF-8. Skipping.")
-                    # files_skipped.append(relative_path + " (UnicodeDecodeError)")
-                    continue
-
-                if ignore_empty_files and not content.strip():
-                    continue
-
-                if "API_KEY" in content and has_api_key(content) and not no_skip:
-                    print(
-                        f"Warning: what seems to be an API KEY was found in {relative_path}. Skipping"
-                    )
-                    files_skipped.append(
-                        relative_path
-                        + " (Potential API key found. Run with --no-skip option to include)"
-                    )
-                    continue
-
-                files_included.append(relative_path)
-                result.append(f"---\nFile: `{relative_path}`\n")
-
-                code_extensions = [
-                    ".py",
-                    ".json",
-                    ".js",
-                    ".html",
-                    ".css",
-                    ".java",
-                    ".cpp",
-                    ".c",
-                    ".h",
-                    ".yaml",
-                    ".yml",
-                ]
-                if any(file.endswith(ext) for ext in code_extensions):
-                    result.append(f"```\n{content}\n```")
-                else:
-                    result.append(content)
-
-                result.append("")  # Add an empty line between files
-
-    return "\n".join(result), files_included, files_skipped
-
-
-def get_metadata(content):
-    token_count = TokenCount(model_name="gpt-3.5-turbo").num_tokens_from_string(content)
-    char_count = sum(not chr.isspace() for chr in content)
+    if parallel_walk:
+        # The parallel walk finds files in no fixed order; keep output stable
+        candidates.sort(key=lambda candidate: candidate[0])
+
+    contents = _read_files([file_path for _, file_path, _ in candidates])
+
+    for i, ((relative_path, file_path, stat), content) in enumerate(
+        zip(candidates, contents)
+    ):
+        if max_tokens and used_tokens >= max_tokens:
+            files_skipped.extend(
+                relative_path + " (Over the --max-tokens budget)"
+                for relative_path, _, _ in candidates[i:]
+            )
+            break
+
+        if content is None:
+            # print(f"Warning: Unable to read {relative_path} as UTF-8. Skipping.")
+            # files_skipped.append(relative_path + " (UnicodeDecodeError)")
+            continue
+
+        if ignore_empty_files and not content.strip():
+            continue
+
+        if not no_skip and has_api_key_near_marker(content):
+            print(
+                f"Warning: what seems to be an API KEY was found in {relative_path}. Skipping"
+            )
+            files_skipped.append(
+                relative_path
+                + " (Potential API key found. Run with --no-skip option to include)"
+            )
+            continue
+
+        if files_included:
+            write(b"\n")  # Add an empty line between files
+
+        files_included.append(relative_path)
+        write(b"---\nFile: `")
+        write(relative_path.encode("utf-8"))
+        write(b"`\n\n")
+
+        block_tokens = None
+        if cache is not None:
+            block_tokens = cache.token_count(file_path, stat, relative_path, content)
+            token_count += block_tokens
+            last_block = (relative_path, content, block_tokens)
+
+        if relative_path.endswith(_CODE_EXTENSIONS):
+            # Appended piece by piece so the content isn't copied into an
+            # intermediate string first
+            write(b"```\n")
+            write(content.encode("utf-8"))
+            write(b"\n```")
+        else:
+            write(content.encode("utf-8"))
+        write(b"\n")
+
+        if max_tokens:
+            if exact_budget:
+                if block_tokens is None:
+                    block_tokens = _count_tokens(_file_block(relative_path, content))
+                used_tokens += block_tokens
+            else:
+                used_tokens += len(content) / _CHARS_PER_TOKEN
+                if used_tokens > _EXACT_COUNT_THRESHOLD * max_tokens:
+                    # One correction round: swap the estimates for an exact
+                    # count of everything written so far
+                    used_tokens = _count_tokens(_written_text(buf, out))
+                    exact_budget = True
+
+    if cache is None:
+        token_count = None
+    elif last_block is not None:
+        # Cached counts include the blank line that follows a block; the last
+        # block has none, so count it as actually written
+        relative_path, content, cached_tokens = last_block
+        token_count += (
+            _count_tokens(_file_block(relative_path, content)[:-1]) - cached_tokens
+        )
+
+    output = bytes(buf) if out is None else None
+    return output, files_included, files_skipped, token_count
+
+
+def _split_lines_into_chunks(text, chunk_size):
+    """Split text into pieces of roughly chunk_size, at line boundaries.
+
+    Only lines followed by a non-whitespace character are split after, since
+    the tokenizer merges runs of whitespace (e.g. a newline and indentation)
+    into one token. That keeps the chunks' token counts adding up exactly.
+    """
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start + chunk_size)
+        while end != -1 and end + 1 < len(text) and text[end + 1].isspace():
+            end = text.find("\n", end + 1)
+        if end == -1:
+            end = len(text)
+        else:
+            end += 1
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+
+def _count_tokens(text):
+    import tiktoken
+
+    # gpt-3.5-turbo / gpt-4 tokenizer
+    encoding = tiktoken.get_encoding("cl100k_base")
+    if len(text) <= _TOKENIZER_CHUNK_SIZE:
+        # Most single files: not worth the batch call's thread pool
+        return len(encoding.encode_ordinary(text))
+
+    # The batch is encoded in parallel by tiktoken's native code
+    chunks = _split_lines_into_chunks(text, _TOKENIZER_CHUNK_SIZE)
+    if len(chunks) == 1:
+        return len(encoding.encode_ordinary(text))
+    return sum(len(tokens) for tokens in encoding.encode_ordinary_batch(chunks))
+
+
+def _fit_to_token_budget(content, token_count, max_tokens):
+    """Work out whether content has to be cut down to fit in max_tokens.
+
+    Returns (keep_bytes, token_count), where keep_bytes is None if content
+    is within _TRUNCATE_TOLERANCE of the budget. Otherwise it is cut by
+    characters, in proportion to how far over budget it is, until it fits.
+    """
+    text = str(content, "utf-8")
+    if token_count is None:
+        token_count = _count_tokens(text)
+    if token_count <= max_tokens * _TRUNCATE_TOLERANCE:
+        return None, token_count
+
+    # Token density varies through the text, so one cut may not be enough
+    while token_count and token_count > max_tokens * _TRUNCATE_TOLERANCE:
+        text = text[: int(len(text) * max_tokens / token_count)]
+        token_count = _count_tokens(text)
+    return len(text.encode("utf-8")), token_count
+
+
+def _map_output(out):
+    """Map the output file back in for reading."""
+    out.flush()
+    # An empty file can't be mapped
+    if not os.fstat(out.fileno()).st_size:
+        return b""
+    return mmap.mmap(out.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _close_quietly(out):
+    """Close an output file whose writes failed, ignoring further errors."""
+    try:
+        out.close()
+    except OSError:
+        pass
+
+
+def get_metadata(content, token_count=None):
+    content = str(content, "utf-8")
+
+    if token_count is None:
+        token_count = _count_tokens(content)
+    # str.split() with no arguments splits on exactly the str.isspace() chars
+    char_count = len("".join(content.split()))
 
     metadata = [
         ["Tokenizer", "openai/tiktoken"],
@@ -100,52 +578,111 @@ def get_metadata(content):
 
 
 def has_api_key(code):
-    # Common API key patterns
-    patterns = [
-        r"[a-zA-Z0-9]{32}",  # 32 alphanumeric characters
-        r"sk_[a-zA-Z0-9]{64}",  # Stripe secret key pattern
-        r"pk_[a-zA-Z0-9]{64}",  # Stripe public key pattern
-        # Add more patterns as needed
-    ]
+    return _API_KEY_RE.search(code) is not None
+
 
-    for pattern in patterns:
-        matches = re.findall(pattern, code)
-        if matches:
+def has_api_key_near_marker(code, marker="API_KEY"):
+    """Check for an API key only in a bounded window around each marker."""
+    idx = code.find(marker)
+    while idx != -1:
+        window = code[
+            max(0, idx - _API_KEY_WINDOW_BEFORE) : idx + _API_KEY_WINDOW_AFTER
+        ]
+        if has_api_key(window):
             return True
+        idx = code.find(marker, idx + len(marker))
 
     return False
 
 
+def _common_prefix_len(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
 def print_directory_tree(file_paths):
-    def nested_dict():
-        return defaultdict(nested_dict)
+    paths = sorted(set(tuple(path.split("/")) for path in file_paths))
+
+    # Walk backwards to work out, for every component of every path, whether
+    # a later sibling follows it (i.e. whether it is the last in its folder)
+    has_sibling_after = []
+    is_last = [None] * len(paths)
+    for i in range(len(paths) - 1, -1, -1):
+        parts = paths[i]
+        common = _common_prefix_len(parts, paths[i + 1]) if i + 1 < len(paths) else -1
+        if common == -1:
+            has_sibling_after = [False] * len(parts)
+        elif common < len(parts):
+            has_sibling_after = (
+                has_sibling_after[:common]
+                + [True]
+                + [False] * (len(parts) - common - 1)
+            )
+        else:
+            has_sibling_after = has_sibling_after[:common]
+        is_last[i] = [not sibling for sibling in has_sibling_after]
+
+    # Then print each path's components that weren't printed for the
+    # previous path
+    print("└── .")
+    previous = ()
+    for parts, last_flags in zip(paths, is_last):
+        common = _common_prefix_len(previous, parts)
+        prefix = "    " + "".join(
+            "    " if last else "│   " for last in last_flags[:common]
+        )
+        for depth in range(common, len(parts)):
+            last = last_flags[depth]
+            print(f"{prefix}{'└── ' if last else '├── '}{parts[depth]}")
+            prefix += "    " if last else "│   "
+        previous = parts
+
+
+def _clipboard_command():
+    """Return the command that copies UTF-8 stdin to the clipboard, if any."""
+    if sys.platform == "darwin":
+        return ["pbcopy"]
+
+    if sys.platform.startswith("linux"):
+        if os.environ.get("WAYLAND_DISPLAY") and shutil.which("wl-copy"):
+            return ["wl-copy"]
+        if shutil.which("xclip"):
+            return ["xclip", "-selection", "clipboard"]
+        if shutil.which("xsel"):
+            return ["xsel", "--clipboard", "--input"]
 
-    tree = nested_dict()
+    return None
 
-    # Populate the tree structure
-    for path in file_paths:
-        parts = path.split("/")
-        current = tree
-        for part in parts:
-            current = current[part]
 
-    # Helper function to print the tree
-    def print_tree(node, name=".", prefix="", is_last=True):
-        print(f"{prefix}{'└── ' if is_last else '├── '}{name}")
-        prefix += "    " if is_last else "│   "
+def _clipboard_copy_bytes(data):
+    """Copy UTF-8 encoded bytes to the clipboard without re-encoding them."""
+    command = _clipboard_command()
+    if command is None:
+        # Windows and other platforms: pyperclip talks to the native API
+        import pyperclip
 
-        if isinstance(node, defaultdict):
-            items = sorted(node.items())
-            for i, (child_name, child) in enumerate(items):
-                is_last_item = i == len(items) - 1
-                print_tree(child, child_name, prefix, is_last_item)
+        pyperclip.copy(str(data, "utf-8"))
+        return
 
-    # Print the tree
-    print_tree(tree)
+    env = None
+    if command[0] == "pbcopy":
+        # pbcopy decodes its input according to the locale
+        env = dict(os.environ, LC_CTYPE="UTF-8")
+    subprocess.run(command, input=data, env=env, check=True)
 
 
 def save_profile(
-    profile_name, include_patterns, exclude_patterns, ignore_empty, no_skip
+    profile_name,
+    include_patterns,
+    exclude_patterns,
+    ignore_empty,
+    no_skip,
+    max_file_bytes=default_max_file_bytes,
+    max_tokens=None,
 ):
     """Save the current configuration as a profile."""
     profile = {
@@ -153,15 +690,17 @@ def save_profile(
         "exclude": exclude_patterns,
         "ignore_empty": ignore_empty,
         "no_skip": no_skip,
+        "max_file_bytes": max_file_bytes,
+        "max_tokens": max_tokens,
     }
 
     # Create dir if it doesn't exist
     os.makedirs(".promptify", exist_ok=True)
 
-    filename = f".promptify/{profile_name}.profile"
+    filename = f".promptify/{profile_name}.profile.json"
     try:
         with open(filename, "w") as f:
-            yaml.dump(profile, f)
+            json.dump(profile, f, indent=2)
         print(f"Profile saved to {filename}")
     except Exception as e:
         print(f"Failed to save profile: {str(e)}")
@@ -169,11 +708,20 @@ def save_profile(
 
 def load_profile(profile_name):
     """Load configuration from a profile."""
-    filename = f".promptify/{profile_name}.profile"
+    filename = f".promptify/{profile_name}.profile.json"
+    legacy_filename = f".promptify/{profile_name}.profile"
     try:
-        with open(filename, "r") as f:
-            profile = yaml.safe_load(f)
-            print(f"Loaded profile from {filename}\n")
+        if not os.path.exists(filename) and os.path.exists(legacy_filename):
+            # Profiles saved by older versions are YAML
+            import yaml
+
+            filename = legacy_filename
+            with open(filename, "r") as f:
+                profile = yaml.safe_load(f)
+        else:
+            with open(filename, "r") as f:
+                profile = json.load(f)
+        print(f"Loaded profile from {filename}\n")
         return profile
     except FileNotFoundError:
         print(f"Profile {filename} not found")
@@ -183,6 +731,26 @@ def load_profile(profile_name):
         return None
 
 
+def _positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
+
+def _non_negative_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"must be a non-negative integer, got {value}")
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be a non-negative integer, got {value}")
+    return number
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Aggregate file contents based on include and exclude patterns."
@@ -209,7 +777,9 @@ def main():
         help="File patterns to exclude (default: %(default)s)",
     )
     parser.add_argument(
-        "--output", type=str, help="Specify the output file name (optional)"
+        "--output",
+        type=str,
+        help="Specify the output file name (optional). The file is overwritten as soon as the run starts",
     )
     parser.add_argument(
         "--ignore-empty",
@@ -221,6 +791,29 @@ def main():
         action="store_true",
         help="Will force the inclusion of files that are skipped due to API keys being found",
     )
+    parser.add_argument(
+        "--max-file-bytes",
+        type=_non_negative_int,
+        default=default_max_file_bytes,
+        metavar="BYTES",
+        help="Skip files larger than this many bytes, 0 for no limit (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=_positive_int,
+        metavar="N",
+        help="Stop adding files once the output reaches about N tokens (N > 0), truncating it if needed (optional)",
+    )
+    parser.add_argument(
+        "--parallel-walk",
+        action="store_true",
+        help="Scan directories on multiple threads. Usually slower on local disks; may only help where listing a directory is slow, e.g. network filesystems (default: False)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't reuse or update the token counts cached from previous runs",
+    )
     parser.add_argument(
         "--export-profile",
         type=str,
@@ -244,14 +837,85 @@ def main():
             args.exclude = profile["exclude"]
             args.ignore_empty = profile["ignore_empty"]
             args.no_skip = profile["no_skip"]
+            # Profiles saved by older versions don't have this setting
+            args.max_file_bytes = profile.get("max_file_bytes", args.max_file_bytes)
+            args.max_tokens = profile.get("max_tokens", args.max_tokens)
 
         else:
             return -1
 
-    output, incl_files, skipped_files = aggregate_file_contents(
-        args.include, args.exclude, args.ignore_empty, args.no_skip
+    # Stream the output straight to the file rather than holding it all in
+    # memory, then map the file back in to count tokens and copy it
+    out = None
+    write_error = None
+    if args.output:
+        try:
+            out = open(args.output, "w+b")
+        except Exception as e:
+            write_error = e
+
+    cache = None
+    if not args.no_cache:
+        try:
+            cache = _Cache()
+        except (OSError, sqlite3.Error) as e:
+            print(f"Failed to open cache, continuing without it: {str(e)}")
+
+    aggregate = functools.partial(
+        aggregate_file_contents,
+        args.include,
+        args.exclude,
+        args.ignore_empty,
+        args.no_skip,
+        args.max_file_bytes,
+        cache,
+        args.parallel_walk,
     )
-    metadata = get_metadata(output)
+    try:
+        try:
+            output, incl_files, skipped_files, token_count = aggregate(
+                out, args.max_tokens
+            )
+            if out is not None:
+                output = _map_output(out)
+        except OSError as e:
+            if out is None:
+                raise
+            # The output file can't be written (e.g. the disk is full): build
+            # the output in memory instead so it can still be copied
+            write_error = e
+            _close_quietly(out)
+            out = None
+            output, incl_files, skipped_files, token_count = aggregate(
+                None, args.max_tokens
+            )
+    finally:
+        if cache is not None:
+            cache.close()
+
+    if args.max_tokens:
+        keep_bytes, token_count = _fit_to_token_budget(
+            output, token_count, args.max_tokens
+        )
+        if keep_bytes is not None:
+            if out is None:
+                output = output[:keep_bytes]
+            else:
+                if isinstance(output, mmap.mmap):
+                    output.close()
+                try:
+                    out.truncate(keep_bytes)
+                    output = _map_output(out)
+                except OSError as e:
+                    # Everything was flushed before, so it can be read back
+                    write_error = e
+                    out.seek(0)
+                    output = out.read(keep_bytes)
+                    _close_quietly(out)
+                    out = None
+            print(f"Output truncated to fit in {args.max_tokens} tokens\n")
+
+    metadata = get_metadata(output, token_count)
 
     # Handle profile export
     if args.export_profile:
@@ -261,8 +925,12 @@ def main():
             args.exclude,
             args.ignore_empty,
             args.no_skip,
+            args.max_file_bytes,
+            args.max_tokens,
         )
 
+    from tabulate import tabulate
+
     print(tabulate(metadata))
     print("Files included:")
     print_directory_tree(incl_files)
@@ -273,23 +941,23 @@ def main():
 
     clipboard_success = False
     try:
-        pyperclip.copy(output)
-        pyperclip.paste()  # This line is just to verify the clipboard contents
+        _clipboard_copy_bytes(output)
         print("\nContents copied to clipboard")
         clipboard_success = True
     except Exception as e:
         print(f"\nFailed to copy contents to clipboard: {str(e)}")
 
     if args.output:
-        try:
-            with open(args.output, "w", encoding="utf-8") as f:
-                f.write(output)
+        if write_error is None:
+            if isinstance(output, mmap.mmap):
+                output.close()
+            out.close()
             print(f"\nOutput written to {args.output}")
-        except Exception as e:
-            print(f"\nFailed to write to file: {str(e)}")
+        else:
+            print(f"\nFailed to write to file: {str(write_error)}")
     elif not clipboard_success:
         try:
-            with open("output.promptify", "w", encoding="utf-8") as f:
+            with open("output.promptify", "wb") as f:
                 f.write(output)
             print("Output written to output.promptify")
         except Exception as e: